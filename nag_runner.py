@@ -1,123 +1,322 @@
 #!/usr/bin/python3
 "Nag Runner: Reminds you to run important commands on a regular basis."
 
-import argparse
-import json
 import os
+import signal
+import stat
 import sys
+import time
 from collections import namedtuple
-from datetime import datetime
-from subprocess import call
+from contextlib import contextmanager
+from functools import cached_property, lru_cache
+
+
+@lru_cache(maxsize=None)
+def _json_module():
+    "Imports orjson on first use, or the stdlib json module without it."
+    # pylint: disable=import-outside-toplevel
+    try:
+        import orjson
+
+        return orjson
+    except ImportError:
+        import json
+
+        return json
+
+
+def _loads(data):
+    "Parses json from bytes."
+    return _json_module().loads(data)
+
+
+def _dumps(obj):
+    "Serializes obj to utf-8 encoded json."
+    dumped = _json_module().dumps(obj)
+    return dumped if isinstance(dumped, bytes) else dumped.encode("utf-8")
 
 
 Entry = namedtuple("Entry", ["name", "command", "interval"])
 
 
+def entry_from_dict(entry_data):
+    "Builds an Entry from a config dict, parsing its interval to an int."
+    return Entry(**{**entry_data, "interval": int(entry_data["interval"])})
+
+
+def is_valid_command(command):
+    "Checks that a command is a shell string or a non-empty list of arguments."
+    if isinstance(command, str):
+        return True
+    return (
+        isinstance(command, list)
+        and bool(command)
+        and all(isinstance(argument, str) for argument in command)
+    )
+
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+
+@lru_cache(maxsize=None)
+def parse_last_run(timestamp):
+    "Converts an ISO timestamp from an older last run file to POSIX seconds."
+    from datetime import datetime  # pylint: disable=import-outside-toplevel
+
+    return datetime.fromisoformat(timestamp).timestamp()
+
+
+def local_seconds(timestamp):
+    "Shifts POSIX seconds to local wall-clock seconds, so DST changes don't count."
+    return timestamp + time.localtime(timestamp).tm_gmtoff
+
+
+_CHOICES = []
+
+
+def choice(method):
+    "Registers a NagRunner method as one of the responses to a prompt."
+    _CHOICES.append(method)
+    return method
+
+
+def exit_on_signal(signum, _frame):
+    "Exits through SystemExit so pending last run times are still flushed."
+    sys.exit(128 + signum)
+
+
+# SIGHUP doesn't exist on Windows.
+_EXIT_SIGNALS = tuple(
+    signum
+    for signum in (getattr(signal, "SIGHUP", None), signal.SIGTERM)
+    if signum is not None
+)
+
+
+@contextmanager
+def exiting_on_signals():
+    "Turns SIGHUP and SIGTERM into SystemExit for the duration of the block."
+    try:
+        previous = [signal.signal(signum, exit_on_signal) for signum in _EXIT_SIGNALS]
+    except ValueError:
+        # Handlers can only be set from the main thread; leave them alone.
+        yield
+        return
+    try:
+        yield
+    finally:
+        for signum, handler in zip(_EXIT_SIGNALS, previous):
+            signal.signal(signum, signal.SIG_DFL if handler is None else handler)
+
+
+_HOME = os.path.expanduser("~")
+_DEFAULT_CONFIG_PATHS = (
+    os.path.join(_HOME, ".config", "nag_runner.json"),
+    os.path.join(_HOME, ".nag_runner.json"),
+)
+_DEFAULT_LAST_RUN = os.path.join(_HOME, ".cache", "nag_runner", "last_run.json")
+
+
 class NagRunner:
     "main class for nag runner."
 
     def __init__(self, config_path, last_run_path=None):
         self.config = self.load_config(config_path)
-        self.last_run_path = last_run_path or os.path.expanduser(
-            "~/.cache/nag_runner/last_run.json"
+        self.last_run_path = last_run_path or _DEFAULT_LAST_RUN
+        self._last_run_cache = None
+        self._last_run_dirty = False
+        self.choice_methods = [getattr(self, method.__name__) for method in _CHOICES]
+        self._choice_letters = "/".join(
+            method.__doc__[0] for method in self.choice_methods
         )
-        self.choice_methods = [
-            getattr(self, method_name)
-            for method_name in dir(self)
-            if method_name.startswith("choice_")
-        ]
+        self._response_map = {
+            method.__doc__[0].lower(): method for method in self.choice_methods
+        }
+        for method in self.choice_methods:
+            if method.__doc__[0].isupper():
+                self._response_map[""] = method
 
     def load_json_file(self, path, default):
         "Loads a json file from the given path."
-        if not os.path.exists(path):
+        try:
+            with open(path, "rb") as file:
+                data = file.read()
+        except FileNotFoundError:
             return default
-        with open(path, "r", encoding="utf-8") as file:
-            return json.load(file)
+        return _loads(data)
 
     def load_config(self, config_file):
         "Loads a list of Entries from the config file."
-        possible_config_files = (
-            [config_file]
-            if config_file
-            else [
-                os.path.expanduser(path)
-                for path in ["~/.config/nag_runner.json", "~/.nag_runner.json"]
-            ]
-        )
+        possible_config_files = [config_file] if config_file else _DEFAULT_CONFIG_PATHS
         for possible_config_file in possible_config_files:
-            entries = self.load_json_file(possible_config_file, [])
-            if entries:
-                return [Entry(**entry_data) for entry_data in entries]
+            entries = self.load_json_file(possible_config_file, None)
+            if entries is not None:
+                return self.validate_config(possible_config_file, entries)
         sys.exit(f"No config file found at {', '.join(possible_config_files)}")
 
-    def get_days_since_last_run(self, entry):
+    def validate_config(self, config_file, entries):
+        "Builds the config's Entries, exiting with an error on any invalid one."
+        config = []
+        for entry_data in entries:
+            missing = [key for key in Entry._fields if key not in entry_data]
+            if missing:
+                sys.exit(
+                    f"Entry {entry_data} in {config_file} is missing"
+                    f" {', '.join(missing)}"
+                )
+            if not is_valid_command(entry_data["command"]):
+                sys.exit(
+                    f"Entry {entry_data} in {config_file} needs a command that is a"
+                    " string or a non-empty list of strings"
+                )
+            try:
+                config.append(entry_from_dict(entry_data))
+            except (TypeError, ValueError) as error:
+                sys.exit(f"Entry {entry_data} in {config_file} is invalid: {error}")
+        return config
+
+    @cached_property
+    def _config_by_name(self):
+        "The Entries from the config file, keyed by name."
+        # Reversed so the first entry wins when names repeat, as a scan would.
+        return {entry.name: entry for entry in reversed(self.config)}
+
+    def _load_last_run(self):
+        "Loads the last run file once and keeps it in memory for the session."
+        if self._last_run_cache is None:
+            self._last_run_cache = self.load_json_file(self.last_run_path, {})
+        return self._last_run_cache
+
+    def get_days_since_last_run(self, entry, last_run_dict=None, now=None):
         "Returns the number of days since the command was last run."
-        last_run_dict = self.load_json_file(self.last_run_path, {})
+        if last_run_dict is None:
+            last_run_dict = self._load_last_run()
         if entry.name not in last_run_dict:
             return None
-        last_run_time = datetime.strptime(
-            last_run_dict[entry.name], "%Y-%m-%dT%H:%M:%S.%f"
-        )
-        return (datetime.now() - last_run_time).days
+        last_run_time = last_run_dict[entry.name]
+        if isinstance(last_run_time, str):
+            last_run_time = parse_last_run(last_run_time)
+        if now is None:
+            now = time.time()
+        elapsed = local_seconds(now) - local_seconds(last_run_time)
+        return int(elapsed // SECONDS_PER_DAY)
 
-    def get_days_to_next_run(self, entry):
+    def get_days_to_next_run(self, entry, last_run_dict=None, now=None):
         "Returns the number of days until the command should be run."
-        days_since = self.get_days_since_last_run(entry)
-        return 0 if days_since is None else int(entry.interval) - days_since
+        days_since = self.get_days_since_last_run(entry, last_run_dict, now)
+        return 0 if days_since is None else entry.interval - days_since
 
-    def get_entry_info(self, entry, show_extras):
+    def get_entry_info(self, entry, show_extras, last_run_dict=None, now=None):
         "gets the entry's name, when it will next run, and how often it runs."
         info = [entry.name]
-        days_since = self.get_days_since_last_run(entry)
+        days_since = self.get_days_since_last_run(entry, last_run_dict, now)
         if days_since is None:
             info.append(" has never run before.")
         else:
             info.append(f" was last run {days_since} days ago.")
         if show_extras:
             info.append(" It runs next in ")
-            info.append(f"{max(self.get_days_to_next_run(entry), 0)} days.")
+            days_to_next = 0 if days_since is None else entry.interval - days_since
+            info.append(f"{max(days_to_next, 0)} days.")
             info.append(f" It runs every {entry.interval} days.")
         return "".join(info)
 
     def run_entry_by_name(self, name):
         "Runs the entry with the given name."
+        try:
+            entry = self._config_by_name[name]
+        except KeyError:
+            sys.exit(f"Could not find entry with name {name}")
+        self.run_entry(entry)
+        self.flush()
+
+    def list_entries(self):
+        "Prints all entries and when they will next run."
+        last_run_dict = self._load_last_run()
+        now = time.time()
         for entry in self.config:
-            if entry.name == name:
-                self.run_entry(entry)
-                return
-        sys.exit(f"Could not find entry with name {name}")
+            print(self.get_entry_info(entry, True, last_run_dict, now))
 
     def run_overdue_entries(self):
         "Runs all overdue entries."
-        for entry in self.config:
-            days_since = self.get_days_since_last_run(entry)
-            if days_since is not None:
-                if days_since < int(entry.interval):
+        last_run_dict = self._load_last_run()
+        now = time.time()
+        try:
+            for entry in self.config:
+                days_since = self.get_days_since_last_run(entry, last_run_dict, now)
+                if days_since is not None and days_since < entry.interval:
                     continue
-            self.run_choice(f"{self.get_entry_info(entry, False)} Run now?", entry)
+                info = self.get_entry_info(entry, False, last_run_dict, now)
+                self.run_choice(f"{info} Run now?", entry)
+        finally:
+            # Keep the entries answered so far if a later prompt raises: Ctrl-C,
+            # end of input, or the SystemExit the CLI's SIGHUP/SIGTERM handlers
+            # raise. Other signals still kill the process without flushing.
+            self.flush()
 
+    @choice
     def run_entry(self, entry):
         "Y: Runs the command and set it's last run date."
-        call(entry.command, shell=True)
-        self.set_last_run(entry)
+        from subprocess import call  # pylint: disable=import-outside-toplevel
 
-    choice_1_run_entry = run_entry
+        # Commands given as a list of arguments are run without a shell.
+        try:
+            call(entry.command, shell=isinstance(entry.command, str))
+        except OSError as error:
+            # Without a shell to report it, a missing program raises instead.
+            print(f"Could not run {entry.name}: {error}", file=sys.stderr)
+            return
+        self.set_last_run(entry)
 
-    def choice_2_print_next_time_message(self, _entry):
+    @choice
+    def print_next_time_message(self, _entry):
         "n: Do not run the command, but still nag me next time."
         print("Ok, I'll nag you next time")
 
+    @choice
     def set_last_run(self, entry):
         "d: Don't run the command, but pretend we did."
-        os.makedirs(os.path.dirname(self.last_run_path), exist_ok=True)
-        last_run = self.load_json_file(self.last_run_path, {})
-        last_run[entry.name] = datetime.now().isoformat()
-        with open(self.last_run_path, "w", encoding="utf-8") as file:
-            json.dump(last_run, file)
+        self._load_last_run()[entry.name] = time.time()
+        self._last_run_dirty = True
+
+    def flush(self):
+        "Writes the last run file if any entry was run since the last flush."
+        if not self._last_run_dirty:
+            return
+        import tempfile  # pylint: disable=import-outside-toplevel
+
+        # Replace the file a symlink points to, not the symlink itself.
+        target_path = os.path.realpath(self.last_run_path)
+        # A unique temp file per process, so shells started together can't
+        # replace each other's half-written file.
+        directory = os.path.dirname(target_path)
+        try:
+            file_descriptor, temp_path = tempfile.mkstemp(suffix=".tmp", dir=directory)
+        except FileNotFoundError:
+            os.makedirs(directory, exist_ok=True)
+            file_descriptor, temp_path = tempfile.mkstemp(suffix=".tmp", dir=directory)
+        try:
+            with open(file_descriptor, "wb") as file:
+                file.write(_dumps(self._last_run_cache))
+            # mkstemp creates the file as 0600; keep the mode a plain open() gave.
+            os.chmod(temp_path, self._last_run_mode(target_path))
+            os.replace(temp_path, target_path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        self._last_run_dirty = False
 
-    choice_3_set_last_run = set_last_run
+    def _last_run_mode(self, path):
+        "Returns the existing file's permissions, or the umask default for a new one."
+        try:
+            return stat.S_IMODE(os.stat(path).st_mode)
+        except FileNotFoundError:
+            umask = os.umask(0)
+            os.umask(umask)
+            return 0o666 & ~umask
 
-    def choice_4_print_menu(self, _entry):
+    @choice
+    def print_menu(self, _entry):
         "?: Show the help menu"
         print("Possible responses are:")
         for method in self.choice_methods:
@@ -126,18 +325,27 @@ class NagRunner:
     def run_choice(self, prompt, entry):
         "Gets the user's choice and runs the appropriate action."
         while True:
-            choice_letters = [method.__doc__[0] for method in self.choice_methods]
-            response = input(f"{prompt} [{'/'.join(choice_letters)}] ").lower()
-            for method in self.choice_methods:
-                if method.__doc__[0].lower() == response or (
-                    method.__doc__[0].isupper() and response == ""
-                ):
-                    method(entry)
-                    if method.__doc__[0] != "?":
-                        return
+            sys.stdout.write(f"{prompt} [{self._choice_letters}] ")
+            sys.stdout.flush()
+            # Closing the terminal at a prompt sends SIGHUP, which would otherwise
+            # kill the process before the answers so far are written. Only do this
+            # while waiting, so a running command is never killed by SystemExit.
+            with exiting_on_signals():
+                line = sys.stdin.readline()
+            if not line:
+                raise EOFError
+            response = line.rstrip("\n").lower()
+            method = self._response_map.get(response)
+            if method:
+                method(entry)
+                if method.__doc__[0] != "?":
+                    return
 
 
-if __name__ == "__main__":
+def parse_args():
+    "Parses the command line arguments."
+    import argparse  # pylint: disable=import-outside-toplevel
+
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument("--config-path", "-c", help="Path to the config file")
     parser.add_argument("--last-run-path", "-l", help="Path to the last run file")
@@ -148,13 +356,19 @@ if __name__ == "__main__":
         action="store_true",
         help="List all entries and when they will next run",
     )
-    args = parser.parse_args()
-
-    nag_runner = NagRunner(args.config_path, args.last_run_path)
-    if args.name:
-        nag_runner.run_entry_by_name(args.name)
-    elif args.list:
-        for config_entry in nag_runner.config:
-            print(nag_runner.get_entry_info(config_entry, True))
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    # With no arguments, as when run from a shell startup file, skip argparse.
+    if len(sys.argv) == 1:
+        NagRunner(None).run_overdue_entries()
     else:
-        nag_runner.run_overdue_entries()
+        args = parse_args()
+        nag_runner = NagRunner(args.config_path, args.last_run_path)
+        if args.name:
+            nag_runner.run_entry_by_name(args.name)
+        elif args.list:
+            nag_runner.list_entries()
+        else:
+            nag_runner.run_overdue_entries()